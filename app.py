@@ -1,13 +1,21 @@
 # app.py
 # Streamlit PDF text stamper — simple UX:
 # - Preview is always clickable: one click sets X/Y (baseline) and refreshes preview once.
-# - No "capture" mode. No extra confirm buttons. Just one "Update Preview" button.
-import io, zipfile
+# - No "capture" mode. No confirm buttons: the preview is cached per setting and simply follows them.
+# - The preview draws the text with Pillow, so only its start point is exact; rotated pages and
+#   characters the Base-14 export can't encode go through the real MuPDF stamp instead.
+import hashlib, io, os, shutil, tempfile
+import numpy as np
 import streamlit as st
 from PIL import Image, ImageDraw
 import fitz  # PyMuPDF
 from streamlit_image_coordinates import streamlit_image_coordinates
 
+from pdf_stamp.core import (
+    PngBytes, display_zoom, draw_crosshair, overlay_copy, parse_pages,
+    per_page_zip, pil_font, preview_zoom, stamp_pages,
+)
+
 st.set_page_config(page_title="PDF Text Stamper (Demo)", layout="wide")
 
 # ---------- session defaults ----------
@@ -22,8 +30,6 @@ ss_default("font_label", "Helvetica")
 ss_default("font_size", 12)
 ss_default("color_hex", "#000000")
 ss_default("pages_str", "")
-ss_default("refresh_preview", True)  # render once at start
-ss_default("_last_preview", None)
 
 # ---------- helpers ----------
 FONT_MAP = {
@@ -31,109 +37,82 @@ FONT_MAP = {
     "Times (Roman)": "tiro",
     "Courier": "cour",
 }
-
-def parse_pages(text: str, total: int):
-    if not text or not text.strip():
-        return list(range(total))
-    out = set()
-    for part in text.split(","):
-        part = part.strip()
-        if not part:
-            continue
-        if "-" in part:
-            a, b = part.split("-", 1)
-            try:
-                a, b = int(a), int(b)
-                if a > b: a, b = b, a
-                a = max(1, a); b = min(total, b)
-                out.update(range(a, b + 1))
-            except ValueError:
-                continue
-        else:
-            try:
-                n = int(part)
-                if 1 <= n <= total:
-                    out.add(n)
-            except ValueError:
-                continue
-    return sorted([p - 1 for p in out])
-
-def hex_to_rgb01(hex_color: str):
-    hex_color = hex_color.lstrip("#")
-    return (int(hex_color[0:2],16)/255.0,
-            int(hex_color[2:4],16)/255.0,
-            int(hex_color[4:6],16)/255.0)
-
-def overlay_copy(src_doc, text: str, coords, pages,
-                 font_size=12, fontname="helv", color_hex="#000000") -> bytes:
-    x, y = coords
-    y = y + font_size  # baseline offset (export + preview match)
-    color = hex_to_rgb01(color_hex)
-
-    ndoc = fitz.open()
+FONT_LABELS = tuple(FONT_MAP)
+FONT_LABEL_INDEX = {label: i for i, label in enumerate(FONT_LABELS)}
+
+# Streamlit-cached wrappers; the PDF/raster work itself lives in pdf_stamp.core.
+@st.cache_resource(max_entries=4, show_spinner=False)
+def open_pdf(pdf_key: str, _uploaded):
+    """Parse the upload once; reruns with the same file reuse the Document.
+
+    On POSIX the upload is spooled to a temp file so MuPDF reads objects from disk on
+    demand instead of holding a second in-memory copy of the whole PDF. The file is
+    unlinked right away; MuPDF keeps its handle, and the space is freed once an
+    evicted Document is garbage collected. Windows can't unlink an open file, so
+    there the Document is opened from memory as before rather than leaking temp files.
+    """
+    if os.name != "posix":
+        return fitz.open(stream=_uploaded.getvalue(), filetype="pdf")
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        _uploaded.seek(0)
+        shutil.copyfileobj(_uploaded, tmp)
     try:
-        font_alias = ndoc.insert_font(fontname=fontname)
-    except Exception:
-        try:
-            font_alias = ndoc.insert_font(fontname="helv")
-        except Exception:
-            font_alias = None
+        return fitz.open(tmp.name)
+    finally:
+        os.unlink(tmp.name)
 
-    for p in pages:
-        ndoc.insert_pdf(src_doc, from_page=p, to_page=p)
-        if text.strip():
-            page = ndoc[-1]
-            kwargs = dict(fontsize=font_size, color=color, overlay=True)
-            if font_alias:
-                kwargs["fontname"] = font_alias
-            page.insert_text((x, y), text, **kwargs)
+@st.cache_data(max_entries=16, show_spinner=False)
+def render_page(_src_doc, pdf_key: str, page_index: int, zoom=1.25) -> Image.Image:
+    """Unstamped page raster, cached per (file, page, zoom)."""
+    pix = _src_doc[page_index].get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False)
+    return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
 
-    out_buf = io.BytesIO()
-    ndoc.save(out_buf)
-    ndoc.close()
-    out_buf.seek(0)
-    return out_buf.read()
-
-def overlay_per_page(src_doc, text: str, coords, pages,
-                     font_size=12, fontname="helv", color_hex="#000000"):
-    files = {}
-    for p in pages:
-        data = overlay_copy(src_doc, text, coords, [p], font_size, fontname, color_hex)
-        files[f"stamped_p{p+1}.pdf"] = data
-    return files
-
-def render_stamped_preview(src_doc, page_index: int, text: str, coords,
+def render_stamped_preview(src_doc, pdf_key: str, page_index: int, text: str, coords,
                            font_size=12, fontname="helv", color_hex="#000000", zoom=1.25) -> Image.Image:
-    """Exact preview: stamp via PyMuPDF in-memory, then rasterize."""
+    """Fast preview: draw the text with Pillow over the cached page raster (export still stamps via PyMuPDF)."""
+    if not text.strip():
+        return render_page(src_doc, pdf_key, page_index, zoom=zoom)  # nothing to stamp
+    if src_doc[page_index].rotation or any(ord(c) > 0xFF for c in text):
+        # insert_text follows /Rotate and turns anything past Latin-1 into "·"; the Pillow
+        # overlay would do neither, so stamp and rasterize the page exactly as the export does.
+        ndoc = stamp_pages(src_doc, text, coords, [page_index], font_size, fontname, color_hex)
+        try:
+            pix = ndoc[0].get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False)
+            return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        finally:
+            ndoc.close()
     x, y = coords
     y_pdf = y + font_size
-    color = hex_to_rgb01(color_hex)
-
-    ndoc = fitz.open()
-    ndoc.insert_pdf(src_doc, from_page=page_index, to_page=page_index)
-
-    try:
-        font_alias = ndoc.insert_font(fontname=fontname)
-    except Exception:
-        try:
-            font_alias = ndoc.insert_font(fontname="helv")
-        except Exception:
-            font_alias = None
-
-    page = ndoc[-1]
-    if text.strip():
-        kwargs = dict(fontsize=font_size, color=color, overlay=True)
-        if font_alias:
-            kwargs["fontname"] = font_alias
-        page.insert_text((x, y_pdf), text, **kwargs)
-
-    mat = fitz.Matrix(zoom, zoom)
-    pix = page.get_pixmap(matrix=mat)
-    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-    ndoc.close()
+    img = render_page(src_doc, pdf_key, page_index, zoom=zoom)  # fresh copy from the cache
+    font = pil_font(fontname, max(1, round(font_size * zoom)))
+    ImageDraw.Draw(img).text((x * zoom, y_pdf * zoom), text, fill=color_hex,
+                             font=font, anchor="ls")  # left/baseline, like insert_text
     return img
 
-# ---------- sidebar (no auto preview updates) ----------
+@st.cache_data(max_entries=32, show_spinner=False)
+def render_preview_png(_src_doc, pdf_key: str, page_index: int, text: str, x: int, y: int,
+                       font_size: int, fontname: str, color_hex: str, zoom: float) -> bytes:
+    """Finished preview (stamp + crosshair) as PNG, cached per settings.
+
+    Reruns with unchanged settings hand the cached bytes to the widget as-is: no
+    raster copy, no drawing, no re-encode.
+    """
+    img = render_stamped_preview(_src_doc, pdf_key, page_index, text, (x, y),
+                                 font_size, fontname, color_hex, zoom)
+    arr = np.array(img)
+    draw_crosshair(arr, int(x * zoom), int((y + font_size) * zoom))
+    img = Image.fromarray(arr)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+@st.cache_data(max_entries=8, show_spinner="Stamping…")
+def export_group(_src_doc, pdf_key: str, text: str, coords, pages: tuple,
+                 font_size=12, fontname="helv", color_hex="#000000") -> bytes:
+    """overlay_copy cached per upload + settings, so re-clicking Export is free."""
+    return overlay_copy(_src_doc, text, coords, list(pages), font_size, fontname, color_hex)
+
+# ---------- sidebar ----------
 with st.sidebar:
     st.header("Stamp Settings")
 
@@ -141,7 +120,7 @@ with st.sidebar:
         "Stamp text", value=st.session_state.stamp_text, placeholder="Type anything…"
     )
     st.session_state.font_label = st.selectbox(
-        "Font", list(FONT_MAP.keys()), index=list(FONT_MAP.keys()).index(st.session_state.font_label)
+        "Font", FONT_LABELS, index=FONT_LABEL_INDEX[st.session_state.font_label]
     )
     st.session_state.font_size = int(st.number_input(
         "Font size", min_value=6, max_value=96, value=st.session_state.font_size, step=1
@@ -152,23 +131,23 @@ with st.sidebar:
         "Pages (e.g., 1-3,5 — blank = all)", value=st.session_state.pages_str
     )
 
-    # X/Y are editable but do not trigger preview refresh until user clicks Update Preview
     st.session_state.x = int(st.number_input("X", min_value=0, max_value=5000, value=st.session_state.x, step=1))
     st.session_state.y = int(st.number_input("Y", min_value=0, max_value=5000, value=st.session_state.y, step=1))
 
-    if st.button("Update Preview"):
-        st.session_state.refresh_preview = True
-
 # ---------- file upload ----------
 uploaded = st.file_uploader("Upload a PDF", type=["pdf"])
 if not uploaded:
     st.info("Upload a PDF to begin.")
     st.stop()
 
-# Open PDF
-pdf_bytes = uploaded.read()
+# Open PDF (parsed once per file, reused across reruns). The digest that keys the
+# caches is computed once per uploaded file, not on every rerun.
+if st.session_state.get("pdf_file_id") != uploaded.file_id:
+    st.session_state.pdf_file_id = uploaded.file_id
+    st.session_state.pdf_hash = hashlib.blake2b(uploaded.getbuffer(), digest_size=16).hexdigest()
+pdf_key = st.session_state.pdf_hash
 try:
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    doc = open_pdf(pdf_key, uploaded)
 except Exception as e:
     st.error(f"Could not read PDF: {e}")
     st.stop()
@@ -176,63 +155,50 @@ except Exception as e:
 total_pages = len(doc)
 pages = parse_pages(st.session_state.pages_str, total_pages)
 if not pages:
-    pages = list(range(total_pages))
+    pages = range(total_pages)
 
 # ---------- preview + click-to-set (single rerun per click) ----------
 col1, col2 = st.columns([3, 2])
 
-with col1:
+@st.fragment
+def preview_fragment(doc, pdf_key: str, page_index: int):
+    # Clicks on the preview rerun only this fragment (not upload/parse/export); Streamlit
+    # keeps the previous preview on screen while the new one renders.
     st.subheader("Preview (click to set coords)")
     try:
-        zoom = 1.25
+        page = doc[page_index]
+        zoom = preview_zoom(page)
+        shown_w = round(page.rect.width * display_zoom(page))
         font_alias = FONT_MAP[st.session_state.font_label]
 
-        # Render (or reuse) preview
-        if st.session_state.refresh_preview or st.session_state._last_preview is None:
-            base_img = render_stamped_preview(
-                doc, pages[0], st.session_state.stamp_text, (st.session_state.x, st.session_state.y),
-                font_size=st.session_state.font_size, fontname=font_alias,
-                color_hex=st.session_state.color_hex, zoom=zoom
+        with st.spinner("Rendering preview…"):
+            png = render_preview_png(
+                doc, pdf_key, page_index, st.session_state.stamp_text, st.session_state.x, st.session_state.y,
+                st.session_state.font_size, font_alias, st.session_state.color_hex, zoom
             )
-            st.session_state._last_preview = base_img
-            st.session_state.refresh_preview = False
-
-        # Draw a small crosshair at current coords (purely visual)
-        img_to_show = st.session_state._last_preview.copy()
-        draw = ImageDraw.Draw(img_to_show)
-        cx = int(st.session_state.x * zoom)
-        cy = int((st.session_state.y + st.session_state.font_size) * zoom)
-        L = 30
-        draw.line((cx - L, cy, cx + L, cy), fill="#FF0000", width=1)
-        draw.line((cx, cy - L, cx, cy + L), fill="#FF0000", width=1)
 
         st.caption("Click where you want the **baseline** of the text to start (one click = one update).")
-        result = streamlit_image_coordinates(img_to_show, key="coord_clicker_simple")
+        result = streamlit_image_coordinates(PngBytes(png), width=shown_w, key="coord_clicker_simple")
 
         # If a new click arrives, update coords and refresh preview once
         if result and "x" in result and "y" in result:
-            new_x = max(0, int(round(result["x"] / zoom)))
-            new_y = max(0, int(round(result["y"] / zoom) - st.session_state.font_size))  # inverse baseline shift
+            # Clicks arrive in displayed pixels; map them back to PDF points
+            scale = (result.get("width") or shown_w) / page.rect.width
+            new_x = max(0, int(round(result["x"] / scale)))
+            new_y = max(0, int(round(result["y"] / scale) - st.session_state.font_size))  # inverse baseline shift
             # Only change if it's a real move, to avoid tiny jitters
             if new_x != st.session_state.x or new_y != st.session_state.y:
                 st.session_state.x = new_x
                 st.session_state.y = new_y
-                st.session_state.refresh_preview = True
-                st.rerun()  # single rerun to show the new preview
+                st.rerun()  # single full-app rerun so Details/Export see the new coords
 
     except Exception as e:
         st.warning(f"Preview failed: {e}")
 
-with col2:
-    st.subheader("Details")
-    st.write(f"**Pages selected:** {', '.join(str(p+1) for p in pages)}")
-    st.write(f"**Text:** `{st.session_state.stamp_text or '(none)'}`")
-    st.write(f"**Font:** {st.session_state.font_label}  •  **Size:** {st.session_state.font_size}")
-    st.write(f"**Color:** {st.session_state.color_hex}")
-    st.write(f"**Coords:** ({st.session_state.x}, {st.session_state.y})  (baseline anchor)")
-    st.caption("Preview only updates on **click** or when you press **Update Preview**.")
-
-    # Export mode selector lives here to avoid extra reruns while editing settings
+@st.fragment
+def export_fragment(doc, pdf_key: str, pages):
+    # Export mode selector lives here to avoid extra reruns while editing settings;
+    # as a fragment, mode switches and Export clicks rerun only this block.
     export_mode = st.radio("Export mode", ["Group (one PDF)", "Per-page (ZIP)"], index=0)
     if st.button("Export"):
         if not st.session_state.stamp_text.strip():
@@ -242,22 +208,28 @@ with col2:
                 font_alias = FONT_MAP[st.session_state.font_label]
                 coords = (st.session_state.x, st.session_state.y)
                 if export_mode.startswith("Group"):
-                    stamped = overlay_copy(doc, st.session_state.stamp_text, coords, pages,
+                    stamped = export_group(doc, pdf_key, st.session_state.stamp_text, coords, tuple(pages),
                                            st.session_state.font_size, font_alias, st.session_state.color_hex)
                     st.download_button("Download stamped PDF", data=stamped,
                                        file_name="stamped_group.pdf", mime="application/pdf")
                 else:
-                    files = overlay_per_page(doc, st.session_state.stamp_text, coords, pages,
+                    zip_bytes = per_page_zip(doc, st.session_state.stamp_text, coords, pages,
                                              st.session_state.font_size, font_alias, st.session_state.color_hex)
-                    zip_buf = io.BytesIO()
-                    with zipfile.ZipFile(zip_buf, "w", zipfile.ZIP_DEFLATED) as zf:
-                        for name, data in files.items():
-                            zf.writestr(name, data)
-                    zip_buf.seek(0)
-                    st.download_button("Download ZIP (per-page PDFs)", data=zip_buf,
+                    st.download_button("Download ZIP (per-page PDFs)", data=zip_bytes,
                                        file_name="stamped_per_page.zip", mime="application/zip")
                 st.success("Export ready below 👇")
             except Exception as e:
                 st.error(f"Export failed: {e}")
 
-doc.close()
+with col1:
+    preview_fragment(doc, pdf_key, pages[0])
+
+with col2:
+    st.subheader("Details")
+    st.write(f"**Pages selected:** {', '.join(str(p+1) for p in pages)}")
+    st.write(f"**Text:** `{st.session_state.stamp_text or '(none)'}`")
+    st.write(f"**Font:** {st.session_state.font_label}  •  **Size:** {st.session_state.font_size}")
+    st.write(f"**Color:** {st.session_state.color_hex}")
+    st.write(f"**Coords:** ({st.session_state.x}, {st.session_state.y})  (baseline anchor)")
+
+    export_fragment(doc, pdf_key, pages)
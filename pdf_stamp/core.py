@@ -0,0 +1,152 @@
+# pdf_stamp/core.py
+# PDF stamping and preview helpers (no Streamlit): page-spec parsing, text stamping,
+# group/per-page export and the small raster utilities the preview uses.
+import io, zipfile
+from functools import lru_cache
+from PIL import ImageFont
+import fitz  # PyMuPDF
+
+RENDER_ZOOM = 1.0    # raster resolution of the preview; the browser upscales it
+DISPLAY_ZOOM = 1.25  # on-screen size of the preview
+PREVIEW_WIDTH = 900  # px; roughly the preview column width
+
+def preview_zoom(page) -> float:
+    """Zoom the preview is rasterized at: RENDER_ZOOM, or less for pages wider than the column."""
+    return min(RENDER_ZOOM, PREVIEW_WIDTH / page.rect.width)
+
+def display_zoom(page) -> float:
+    """Zoom the preview is shown at (clicks are mapped back through this)."""
+    return min(DISPLAY_ZOOM, PREVIEW_WIDTH / page.rect.width)
+
+def merge_runs(intervals):
+    """Sort inclusive (a, b) intervals and coalesce overlapping/adjacent ones."""
+    merged = []
+    for a, b in sorted(intervals):
+        if merged and a <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], b))
+        else:
+            merged.append((a, b))
+    return merged
+
+def parse_pages(text: str, total: int):
+    if not text or not text.strip():
+        return range(total)  # lazy: callers only iterate, index and take len()
+    # Work on the k typed ranges (O(k log k)) rather than on every page number;
+    # pages are only materialized once, already sorted and de-duplicated.
+    intervals = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        a, sep, b = part.partition("-")
+        try:
+            # int() as before, so "+3", "1_0" or "3--5" mean what they always did
+            a = int(a)
+            b = int(b) if sep else a
+        except ValueError:
+            continue
+        if a > b: a, b = b, a
+        a, b = max(1, a), min(total, b)
+        if a <= b:
+            intervals.append((a - 1, b - 1))
+    return [p for a, b in merge_runs(intervals) for p in range(a, b + 1)]
+
+@lru_cache(maxsize=256)
+def hex_to_rgb01(hex_color: str):
+    v = int(hex_color.lstrip("#"), 16)
+    return ((v >> 16) / 255.0,
+            ((v >> 8) & 0xFF) / 255.0,
+            (v & 0xFF) / 255.0)
+
+@lru_cache(maxsize=32)
+def resolve_font(fontname: str):
+    """(alias, fitz.Font) for a font name, falling back to Helvetica; resolved once per name."""
+    try:
+        return fontname, fitz.Font(fontname)
+    except Exception:
+        return "helv", fitz.Font("helv")
+
+def stamp_pages(src_doc, text: str, coords, pages,
+                font_size=12, fontname="helv", color_hex="#000000"):
+    """Copy `pages` of src_doc into a new document and stamp each one. Caller closes it."""
+    x, y = coords
+    y = y + font_size  # baseline offset (export + preview match)
+
+    ndoc = fitz.open()
+    # One graft per contiguous run of pages (a single call for "all pages"), so MuPDF
+    # walks the source xref once per run instead of once per page, and nothing
+    # unselected is copied in.
+    for a, b in merge_runs((p, p) for p in pages):
+        ndoc.insert_pdf(src_doc, from_page=a, to_page=b)
+
+    if text.strip():
+        kwargs = dict(fontsize=font_size, fontname=resolve_font(fontname)[0],
+                      color=hex_to_rgb01(color_hex), overlay=True)
+        for page in ndoc:
+            page.insert_text((x, y), text, **kwargs)
+    return ndoc
+
+def overlay_copy(src_doc, text: str, coords, pages,
+                 font_size=12, fontname="helv", color_hex="#000000") -> bytes:
+    ndoc = stamp_pages(src_doc, text, coords, pages, font_size, fontname, color_hex)
+    try:
+        return ndoc.tobytes()
+    finally:
+        ndoc.close()
+
+def overlay_per_page(src_doc, text: str, coords, pages,
+                     font_size=12, fontname="helv", color_hex="#000000"):
+    """Yield (file name, single-page PDF bytes) in page order, one file at a time."""
+    # Stamp every selected page once, then split: src_doc is grafted a single time
+    # instead of once per output file.
+    ndoc = stamp_pages(src_doc, text, coords, pages, font_size, fontname, color_hex)
+    try:
+        for i, p in enumerate(pages):
+            out = fitz.open()
+            try:
+                out.insert_pdf(ndoc, from_page=i, to_page=i)
+                data = out.tobytes()
+            finally:
+                out.close()
+            yield f"stamped_p{p+1}.pdf", data
+    finally:
+        ndoc.close()
+
+def per_page_zip(src_doc, text: str, coords, pages,
+                 font_size=12, fontname="helv", color_hex="#000000") -> bytes:
+    zip_buf = io.BytesIO()
+    # PDF streams are already compressed; ZIP_STORED skips a pointless deflate pass,
+    # and each PDF is written (and dropped) as soon as it is produced.
+    with zipfile.ZipFile(zip_buf, "w", zipfile.ZIP_STORED) as zf:
+        for name, data in overlay_per_page(src_doc, text, coords, pages, font_size, fontname, color_hex):
+            zf.writestr(name, data)
+    return zip_buf.getvalue()
+
+class PngBytes:
+    """Already-encoded PNG; image widgets "save" it as-is instead of re-encoding a PIL image."""
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def save(self, fp, format=None, **kwargs):
+        fp.write(self.data)
+
+@lru_cache(maxsize=32)
+def pil_font(fontname: str, size_px: int):
+    """PIL font loaded from the MuPDF Base-14 program the export names.
+
+    Same glyph shapes, but Pillow hints advances to whole pixels, so only the start
+    anchor matches the export exactly; long lines drift (Courier 12pt at zoom 1.0
+    ends ~12 px short over 63 characters).
+    """
+    try:
+        return ImageFont.truetype(io.BytesIO(resolve_font(fontname)[1].buffer), size_px)
+    except Exception:
+        return ImageFont.load_default(size_px)
+
+def draw_crosshair(arr, cx: int, cy: int, half=30, color=(255, 0, 0)):
+    """Draw a 1-px crosshair into an HxWx3 uint8 array in place, clipped to the image."""
+    h, w = arr.shape[:2]
+    if 0 <= cy < h:
+        arr[cy, max(0, cx - half):max(0, cx + half + 1)] = color
+    if 0 <= cx < w:
+        arr[max(0, cy - half):max(0, cy + half + 1), cx] = color